@@ -2,6 +2,7 @@ import copy
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import requests
@@ -11,11 +12,16 @@ from dotenv import load_dotenv
 from forge_api import ForgeApi
 from utils import (
     cat_paths,
+    content_hash,
     get_domains_certificate,
+    get_site_dir,
+    load_cached_config,
     load_config,
     parse_env,
+    read_file,
     replace_nginx_variables,
     replace_secrets_yaml,
+    store_cached_config,
     validate_yaml_data,
     wait,
 )
@@ -29,6 +35,8 @@ WORKFLOW_REPO_PATH = os.getenv("GITHUB_WORKSPACE", "./")
 DEPLOYMENT_FILE_NAME = os.getenv("DEPLOYMENT_FILE", "forge-deploy.yml")
 FORGE_API_TOKEN = os.getenv("FORGE_API_TOKEN")
 SECRETS_ENV = os.getenv("SECRETS", None)
+# opt-in cache of the parsed and validated config, see get_config_cache_path
+CONFIG_CACHE = os.getenv("FORGE_CONFIG_CACHE") == "1"
 
 logging.basicConfig(
     level=logging.INFO if not DEBUG else logging.DEBUG,
@@ -38,22 +46,24 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def main():
-    action_dir = cat_paths(
-        os.path.dirname(__file__), "../"
-    )  # path of the action directory (parent directory of this file)
-    forge_uri = "https://forge.laravel.com/api/v1"
-    if FORGE_API_TOKEN is None:
-        raise Exception("FORGE_API_TOKEN is not set")
+def get_config_cache_path(raw_yaml):
+    # the key also covers the code that builds the config, so a config cached by
+    # another version of the action is never loaded
+    src_dir = os.path.dirname(__file__)
+    code = "".join(
+        read_file(cat_paths(src_dir, name))
+        for name in ("deploy.py", "utils.py", "schema.py")
+    )
+    cache_key = content_hash("\0".join((code, raw_yaml, SECRETS_ENV or "")))
+    return cat_paths(
+        Path.home(), ".cache", "forge-deployment-scripts", f"{cache_key}.pkl"
+    )
 
-    dep_file = cat_paths(WORKFLOW_REPO_PATH, DEPLOYMENT_FILE_NAME)
 
+def parse_deployment_config(raw_yaml):
     try:
-        with open(dep_file, "r") as file:
-            data = yaml.safe_load(file)
-            logger.debug("YAML data: %s", data)
-    except FileNotFoundError as e:
-        raise Exception(f"The configuration file {dep_file} is missing.") from e
+        data = yaml.safe_load(raw_yaml)
+        logger.debug("YAML data: %s", data)
     except yaml.YAMLError as e:
         raise Exception(f"Error parsing YAML file: {e}") from e
 
@@ -68,13 +78,41 @@ def main():
 
     validate_yaml_data(data)
 
-    config = load_config(data)
+    return load_config(data)
+
+
+def main():
+    action_dir = cat_paths(
+        os.path.dirname(__file__), "../"
+    )  # path of the action directory (parent directory of this file)
+    if FORGE_API_TOKEN is None:
+        raise Exception("FORGE_API_TOKEN is not set")
+
+    dep_file = cat_paths(WORKFLOW_REPO_PATH, DEPLOYMENT_FILE_NAME)
+
+    try:
+        raw_yaml = read_file(dep_file)
+    except FileNotFoundError as e:
+        raise Exception(f"The configuration file {dep_file} is missing.") from e
 
-    # hide env to log config safely
-    log_config = copy.deepcopy(config)
-    for site in log_config["sites"]:
-        site["environment"] = "*****"
-    logger.debug("Config: %s", log_config)
+    config = None
+    if CONFIG_CACHE:
+        config_cache_path = get_config_cache_path(raw_yaml)
+        config = load_cached_config(config_cache_path)
+        if config is not None:
+            logger.debug("Config loaded from cache `%s`", config_cache_path)
+
+    if config is None:
+        config = parse_deployment_config(raw_yaml)
+        if CONFIG_CACHE:
+            store_cached_config(config_cache_path, config)
+
+    # hide env to log config safely, the copy is only made when debug logs are enabled
+    if logger.isEnabledFor(logging.DEBUG):
+        log_config = copy.deepcopy(config)
+        for site in log_config["sites"]:
+            site["environment"] = "*****"
+        logger.debug("Config: %s", log_config)
 
     session = requests.sessions.Session()
     session.headers.update(
@@ -87,91 +125,85 @@ def main():
 
     forge_api = ForgeApi(session)
 
-    try:
-        response = session.get(f"{forge_uri}/servers")
-        response.raise_for_status()
-    except requests.RequestException as e:
-        raise Exception("Failed to get server from Laravel Forge API") from e
-
-    server_id = next(
-        (
-            server["id"]
-            for server in response.json()["servers"]
-            if server["name"] == config["server_name"]
-        ),
-        None,
-    )
-    if not server_id:
+    servers_by_name = {server["name"]: server for server in forge_api.get_servers()}
+    if config["server_name"] not in servers_by_name:
         raise Exception(f"Server `{config["server_name"]}` not found")
-
-    # sites
-    sites = forge_api.get_all_sites(server_id)
+    server_id = servers_by_name[config["server_name"]]["id"]
+
+    # server level state is shared by all sites, fetch it once before the site loop
+    # and keep it up to date with the changes made by each site
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        sites_future = executor.submit(forge_api.get_all_sites_by_name, server_id)
+        nginx_templates_future = executor.submit(
+            forge_api.get_nginx_templates, server_id
+        )
+        php_versions_future = executor.submit(
+            forge_api.get_server_installed_php_versions, server_id
+        )
+        daemons_future = executor.submit(forge_api.list_daemons, server_id)
+
+    sites_by_name = sites_future.result()
+    nginx_templates_by_name = {
+        template["name"]: template for template in nginx_templates_future.result()
+    }
+    installed_php_versions = {php["version"] for php in php_versions_future.result()}
+    # a copy, the list is kept up to date below and the memoized one must not change
+    server_daemons = list(daemons_future.result())
+    # content hash of the server nginx templates by id
+    server_template_hashes = {}
 
     for site_conf in config["sites"]:
         print("\n")
-        logger.info(f"\t---- Site: {site_conf['site_domain']} ----")
+        logger.info("\t---- Site: %s ----", site_conf["site_domain"])
 
-        site = next(
-            (site for site in sites if site["name"] == site_conf["site_domain"]),
-            None,
-        )
+        site = sites_by_name.get(site_conf["site_domain"])
 
         # create site
         if not site:
             # nginx template
 
-            nginx_templates = forge_api.get_nginx_templates(server_id)
-            nginx_template_id = next(
-                (
-                    item["id"]
-                    for item in nginx_templates
-                    if item["name"] == site_conf["nginx_template"]
-                ),
-                None,
-            )
+            nginx_template = nginx_templates_by_name.get(site_conf["nginx_template"])
+            nginx_template_id = nginx_template["id"] if nginx_template else None
 
-            # if template isn't added in the server add it from nginx-templates folder
+            # local template from the nginx-templates folder
             nginx_template_path = cat_paths(
                 action_dir, "nginx_templates/", f"{site_conf['nginx_template']}.conf"
             )
+            local_template = None
+            if os.path.isfile(nginx_template_path):
+                local_template = read_file(nginx_template_path)
+
+            # if template isn't added in the server add it from nginx-templates folder
             if not nginx_template_id:
                 logger.info("Nginx template not created in the server")
                 logger.info("Creating nginx template...")
-                if os.path.exists(nginx_template_path):
-                    with open(
-                        nginx_template_path,
-                        "r",
-                    ) as file:
-                        nginx_template_id = forge_api.create_nginx_template(
-                            server_id, site_conf["nginx_template"], file.read()
-                        )
-                        logger.info("Nginx template created successfully")
-                else:
+                if local_template is None:
                     raise Exception("Invalid nginx template name")
-            # else update the template if it changed
-            else:
-                server_template = forge_api.get_nginx_template_by_id(
-                    server_id, nginx_template_id
+                nginx_template_id = forge_api.create_nginx_template(
+                    server_id, site_conf["nginx_template"], local_template
                 )
-                if os.path.exists(nginx_template_path):
-                    with open(
-                        nginx_template_path,
-                        "r",
-                    ) as file:
-                        local_template = file.read()
-
-                    if server_template != local_template:
-                        try:
-                            response = session.put(
-                                f"{forge_uri}/servers/{server_id}/nginx/templates/{nginx_template_id}",
-                                json={"content": local_template},
-                            )
-                            response.raise_for_status()
-                            logger.info("Nginx template updated successfully")
-                        except requests.RequestException as e:
-                            raise Exception(
-                                "Failed to update nginx template from Laravel Forge API"
-                            ) from e
+                server_template_hashes[nginx_template_id] = content_hash(local_template)
+                nginx_templates_by_name[site_conf["nginx_template"]] = {
+                    "id": nginx_template_id,
+                    "name": site_conf["nginx_template"],
+                }
+                logger.info("Nginx template created successfully")
+            # else update the template if it changed
+            elif local_template is not None:
+                local_template_hash = content_hash(local_template)
+
+                # sites sharing a template only fetch the server copy once
+                if nginx_template_id not in server_template_hashes:
+                    server_template_hashes[nginx_template_id] = content_hash(
+                        forge_api.get_nginx_template_by_id(server_id, nginx_template_id)
+                    )
+
+                if server_template_hashes[nginx_template_id] != local_template_hash:
+                    forge_api.update_nginx_template(
+                        server_id, nginx_template_id, local_template
+                    )
+                    server_template_hashes[nginx_template_id] = local_template_hash
+                    logger.info("Nginx template updated successfully")
 
             create_site_payload = {
                 "domain": site_conf["site_domain"],
@@ -209,7 +241,7 @@ def main():
             logger.info("Site already exists")
 
         site_id = site["id"]
-        logger.debug(f"Site: %s", site)
+        logger.debug("Site: %s", site)
 
         # ---- update aliases ----
         try:
@@ -230,11 +262,10 @@ def main():
                 nginx_custom_file_path = cat_paths(
                     WORKFLOW_REPO_PATH, site_conf["nginx_custom_config"]
                 )
-                with open(nginx_custom_file_path, "r") as file:
-                    nginx_custom_content = file.read()
+                nginx_custom_content = read_file(nginx_custom_file_path)
 
                 logger.debug(
-                    f"Nginx custom config file content:\n{nginx_custom_content}"
+                    "Nginx custom config file content:\n%s", nginx_custom_content
                 )
                 # compare existing site nginx config and the one in the file if different update
                 site_existing_nginx_config = forge_api.get_nginx_config(
@@ -242,7 +273,7 @@ def main():
                 )
                 if site_existing_nginx_config != nginx_custom_content:
                     forge_api.set_nginx_config(server_id, site_id, nginx_custom_content)
-                    logger.info(f"Nginx config updated.")
+                    logger.info("Nginx config updated.")
         except FileNotFoundError as e:
             raise Exception(
                 f"Nginx config file `{site_conf["nginx_custom_config"]} doesn't exist."
@@ -261,27 +292,20 @@ def main():
 
         if site_conf["php_version"] and site_conf["php_version"] != site_php_version:
             # check if version is installed, if not install it
-            server_php_versions = forge_api.get_server_installed_php_versions(server_id)
-            if site_conf["php_version"] not in [
-                php["version"] for php in server_php_versions
-            ]:
+            # versions installed for an earlier site are already in the set
+            if site_conf["php_version"] not in installed_php_versions:
                 logger.info("Installing php version...")
                 try:
-                    response = session.post(
-                        f"{forge_uri}/servers/{server_id}/php",
-                        json={"version": site_conf["php_version"]},
-                    )
-                    response.raise_for_status()
                     forge_api.install_php_version(server_id, site_conf["php_version"])
 
                     # wait for installation
                     def until_php_installed():
-                        res = session.get(f"{forge_uri}/servers/{server_id}/php")
-                        res.raise_for_status()
                         installed_php = next(
                             (
                                 php
-                                for php in res.json()
+                                for php in forge_api.get_server_installed_php_versions(
+                                    server_id
+                                )
                                 if php["version"] == site_conf["php_version"]
                             ),
                         )
@@ -292,22 +316,19 @@ def main():
                 except Exception as e:
                     raise Exception(f"Failed to install php version: {e}") from e
 
-                logger.info(f"Php version {site_conf['php_version']} installed")
+                installed_php_versions.add(site_conf["php_version"])
+                logger.info("Php version %s installed", site_conf["php_version"])
 
             # update site php version
             try:
-                res = session.put(
-                    f"{forge_uri}/servers/{server_id}/sites/{site_id}/php",
-                    json={"version": site_conf["php_version"]},
+                forge_api.update_php_version(
+                    server_id, site_id, site_conf["php_version"]
                 )
-                res.raise_for_status()
             except Exception as e:
                 raise Exception(f"Failed to update site php version: {e}") from e
-            logger.info(f"Php version set to {site_conf["php_version"]}")
+            logger.info("Php version set to %s", site_conf["php_version"])
 
-        site_dir = str(
-            Path("/home/forge/") / site_conf["site_domain"] / site_conf["root_dir"]
-        )
+        site_dir = get_site_dir(site_conf)
 
         # add repository
         if (
@@ -316,18 +337,16 @@ def main():
         ):
             logger.info("Adding repository...")
             try:
-                response = session.post(
-                    f"{forge_uri}/servers/{server_id}/sites/{site_id}/git",
-                    json={
+                site = forge_api.install_repository(
+                    server_id,
+                    site_id,
+                    {
                         "provider": "github",
                         "repository": config["github_repository"],
                         "branch": config["github_branch"],
                         "composer": False,
                     },
                 )
-                response.raise_for_status()
-
-                site = response.json()["site"]
 
                 def until_repo_installed():
                     site = forge_api.get_site_by_id(server_id, site_id)
@@ -342,47 +361,58 @@ def main():
 
         # create daemons
         try:
-            daemon_ids = []
-            # get existing site daemons
-            response = session.get(f"{forge_uri}/servers/{server_id}/daemons")
-            response.raise_for_status()
             # existing site daemons
             site_daemons = [
-                daemon
-                for daemon in response.json()["daemons"]
-                if daemon["directory"] == site_dir
+                daemon for daemon in server_daemons if daemon["directory"] == site_dir
             ]
-            # delete daemon if not in the config
-            for dm in site_daemons:
-                if dm["command"] not in [
-                    daemon["command"] for daemon in site_conf["daemons"]
-                ]:
-                    response = session.delete(
-                        f"{forge_uri}/servers/{server_id}/daemons/{dm['id']}"
-                    )
-                    response.raise_for_status()
-                    logger.info(f"Daemon-{dm["id"]} `{dm["command"]}` deleted.")
-                else:
-                    daemon_ids.append(dm["id"])
+            existing_commands = {dm["command"] for dm in site_daemons}
+            desired_commands = {daemon["command"] for daemon in site_conf["daemons"]}
 
+            daemon_ids = [
+                dm["id"] for dm in site_daemons if dm["command"] in desired_commands
+            ]
+            # delete daemon if not in the config
+            daemons_to_delete = [
+                dm for dm in site_daemons if dm["command"] not in desired_commands
+            ]
             # add new daemons
-            for daemon in site_conf["daemons"]:
-                if daemon["command"] not in [dm["command"] for dm in site_daemons]:
-                    response = session.post(
-                        f"{forge_uri}/servers/{server_id}/daemons",
-                        json={
-                            "command": daemon["command"],
-                            "user": "forge",
-                            "directory": site_dir,
-                            "startsecs": 1,
-                        },
-                    )
-                    response.raise_for_status()
-                    new_daemon = response.json()["daemon"]
-                    daemon_ids.append(new_daemon["id"])
-                    logger.info(
-                        f"Daemon-{new_daemon["id"]} `{new_daemon["command"]}` created."
-                    )
+            daemons_to_create = [
+                daemon
+                for daemon in site_conf["daemons"]
+                if daemon["command"] not in existing_commands
+            ]
+
+            def delete_daemon(dm):
+                forge_api.delete_daemon(server_id, dm["id"])
+
+            def create_daemon(daemon):
+                return forge_api.create_daemon(
+                    server_id,
+                    {
+                        "command": daemon["command"],
+                        "user": "forge",
+                        "directory": site_dir,
+                        "startsecs": 1,
+                    },
+                )
+
+            # daemon changes are independent of each other, send them concurrently
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                deleted = executor.map(delete_daemon, daemons_to_delete)
+                created = executor.map(create_daemon, daemons_to_create)
+                list(deleted)
+                new_daemons = list(created)
+
+            for dm in daemons_to_delete:
+                server_daemons.remove(dm)
+                logger.info("Daemon-%s `%s` deleted.", dm["id"], dm["command"])
+            # new daemons keep the order of the config
+            for new_daemon in new_daemons:
+                server_daemons.append(new_daemon)
+                daemon_ids.append(new_daemon["id"])
+                logger.info(
+                    "Daemon-%s `%s` created.", new_daemon["id"], new_daemon["command"]
+                )
         except Exception as e:
             raise Exception(f"Failed to add daemons: {e}") from e
 
@@ -400,54 +430,45 @@ def main():
                 deployment_script += f"sudo -S supervisorctl restart daemon-{d_id}:*\n"
 
             try:
-                response = session.put(
-                    f"{forge_uri}/servers/{server_id}/sites/{site_id}/deployment/script",
-                    json={
-                        "content": deployment_script,
-                        # disabled auto_source because it causes a problem when code is not in root directory
-                        # because forge creates the env file in the specified directory, but tries to source it from root
-                        "auto_source": False,
-                    },
-                )
-                response.raise_for_status()
-            except requests.RequestException as e:
+                # skip the update when the script on forge is already up to date
+                if (
+                    forge_api.get_deployment_script(server_id, site_id)
+                    != deployment_script
+                ):
+                    # disabled auto_source because it causes a problem when code is not in root directory
+                    # because forge creates the env file in the specified directory, but tries to source it from root
+                    forge_api.set_deployment_script(
+                        server_id, site_id, deployment_script, auto_source=False
+                    )
+                    logger.info("Deployment script added successfully")
+            except Exception as e:
                 raise Exception(f"Failed to add deployment script: {e}") from e
 
-            logger.info("Deployment script added successfully")
-
         # set env
         try:
-            site_env = {}
+            file_env = {}
             # read env file
             if site_conf["env_file"]:
                 env_file_path = cat_paths(WORKFLOW_REPO_PATH, site_conf["env_file"])
                 try:
-                    with open(env_file_path, "r") as file:
-                        logger.info(
-                            "Loading environment variables from file `%s`",
-                            site_conf["env_file"],
-                        )
-                        file_env = parse_env(file.read())
-                        logger.debug("Env variables loaded from file:\n%s", file_env)
-                        site_env.update(file_env)
+                    file_content = read_file(env_file_path)
+                    logger.info(
+                        "Loading environment variables from file `%s`",
+                        site_conf["env_file"],
+                    )
+                    file_env = parse_env(file_content)
+                    logger.debug("Env variables loaded from file:\n%s", file_env)
                 except FileNotFoundError as e:
                     raise Exception(
                         f"Environment file `{site_conf['env_file']}` not found"
                     ) from e
 
-            if site_conf["environment"]:
-                config_env = parse_env(site_conf["environment"])
-                site_env.update(config_env)
+            # environment from the config takes precedence over the env file
+            site_env = {**file_env, **parse_env(site_conf["environment"])}
 
-            env_str = "\n".join([f"{k}={v}" for k, v in site_env.items()])
-            if len(env_str) > 0:
-                response = session.put(
-                    f"{forge_uri}/servers/{server_id}/sites/{site_id}/env",
-                    json={
-                        "content": env_str,
-                    },
-                )
-                response.raise_for_status()
+            env_str = "\n".join(f"{k}={v}" for k, v in site_env.items())
+            if len(env_str) > 0 and forge_api.get_env(server_id, site_id) != env_str:
+                forge_api.set_env(server_id, site_id, env_str)
                 logger.info("Environment variables set successfully")
 
         except Exception as e:
@@ -484,43 +505,28 @@ def main():
                         server_id, site_id, site_certificate["id"]
                     )
                     logger.info("Certificate activated successfully")
-        except requests.RequestException as e:
+        except Exception as e:
             raise Exception(f"Failed to add certificate: {e}") from e
 
         # deploy site
         if site_conf["clone_repository"]:
             logger.info("Deploying site...")
-            response = session.post(
-                f"{forge_uri}/servers/{server_id}/sites/{site_id}/deployment/deploy"
-            )
-            response.raise_for_status()
-            site = response.json()["site"]
+            site = forge_api.deploy_site(server_id, site_id)
 
             def until_site_deployed():
-                site = session.get(
-                    f"{forge_uri}/servers/{server_id}/sites/{site_id}"
-                ).json()["site"]
+                site = forge_api.get_site_by_id(server_id, site_id)
                 return site["deployment_status"] == None
 
             if not wait(until_site_deployed, max_retries=-1):
                 raise Exception("Deploying site timed out")
 
             # get deployment log
-            try:
-                response = session.get(
-                    f"{forge_uri}/servers/{server_id}/sites/{site_id}/deployment/log",
-                )
-                response.raise_for_status()
-                dep_log = response.content.decode("utf-8")
+            dep_log = forge_api.get_deployment_log(server_id, site_id)
+            if dep_log is not None:
                 logger.info("Deployment log:\n%s", dep_log)
-            except requests.exceptions.HTTPError as e:
-                if response.status_code != 404:
-                    raise Exception("Failed to get deployment log") from e
 
             # check deployment status
-            deployment = session.get(
-                f"{forge_uri}/servers/{server_id}/sites/{site_id}/deployment-history",
-            ).json()["deployments"][0]
+            deployment = forge_api.get_deployment_history(server_id, site_id)[0]
             if deployment["status"] == "failed":
                 raise Exception("Deployment failed")
 
@@ -530,9 +536,6 @@ def main():
 if __name__ == "__main__":
     try:
         main()
-    except requests.exceptions.HTTPError as http_err:
-        logger.error("HTTP error occurred: %s", http_err, exc_info=True)
-        sys.exit(1)
     except Exception as err:
         logger.error("An error occurred:\n %s", err, exc_info=True)
         sys.exit(1)
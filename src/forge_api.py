@@ -1,181 +1,369 @@
+import functools
+import time
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils import rjson
+
+
+def _cached(ttl):
+    """Memoize a ForgeApi method by its arguments for `ttl` seconds."""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            key = (method.__name__, args)
+            cached = self._cache.get(key)
+            if cached and time.monotonic() - cached[0] < ttl:
+                return cached[1]
+            value = method(self, *args)
+            self._cache[key] = (time.monotonic(), value)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def _view_of(source):
+    """Memoize a view built from the result of the cached `source` method.
+
+    The view is rebuilt whenever `source` returns a new result, so it never outlives
+    the listing it was built from.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            items = getattr(self, source)(*args)
+            key = (method.__name__, args)
+            cached = self._views.get(key)
+            if cached and cached[0] is items:
+                return cached[1]
+            value = method(self, items)
+            self._views[key] = (items, value)
+            return value
+
+        return wrapper
+
+    return decorator
 
 
 class ForgeApi:
     def __init__(self, session):
         self.session = session
         self.forge_uri = "https://forge.laravel.com/api/v1"
+        self._cache = {}
+        self._views = {}
+        # reuse connections across calls and retry rate limits and server errors,
+        # POST isn't retried since forge may have created the resource already
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                backoff_jitter=0.5,
+                respect_retry_after_header=True,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(["GET", "PUT", "DELETE"]),
+            ),
+        )
+        self.session.mount("https://", adapter)
 
-    # --- Sites ---
-    def create_site(self, server_id, payload):
+    def invalidate(self, *names):
+        """Drop the cached results of the methods named `names`, of all when empty.
+
+        The views of a dropped listing are rebuilt the next time it's fetched.
+        """
+        if not names:
+            self._cache.clear()
+            self._views.clear()
+            return
+        for cache in (self._cache, self._views):
+            for key in list(cache):
+                if key[0] in names:
+                    cache.pop(key, None)
+
+    def _request(self, method, path, *, op, allow_missing=False, **kwargs):
+        # serialize json bodies with orjson instead of requests' stdlib json.dumps
+        if "json" in kwargs:
+            kwargs["data"] = orjson.dumps(kwargs.pop("json"))
+            kwargs["headers"] = {
+                "Content-Type": "application/json",
+                **kwargs.get("headers", {}),
+            }
         try:
-            response = self.session.post(
-                f"{self.forge_uri}/servers/{server_id}/sites",
-                json=payload,
+            response = self.session.request(
+                method, f"{self.forge_uri}{path}", timeout=30, **kwargs
             )
+            if allow_missing and response.status_code == 404:
+                return None
             response.raise_for_status()
-            return response.json()["site"]
-
+            return response
         except requests.RequestException as e:
-            raise Exception("Failed to create site from Laravel Forge API") from e
+            raise Exception(f"Failed to {op} from Laravel Forge API") from e
 
+    # --- Servers ---
+
+    def get_servers(self):
+        response = self._request("GET", "/servers", op="get servers")
+        return rjson(response)["servers"]
+
+    # --- Sites ---
+    def create_site(self, server_id, payload):
+        response = self._request(
+            "POST", f"/servers/{server_id}/sites", op="create site", json=payload
+        )
+        self.invalidate("get_all_sites")
+        return rjson(response)["site"]
+
+    @_cached(ttl=30)
     def get_all_sites(self, server_id):
-        try:
-            response = self.session.get(f"{self.forge_uri}/servers/{server_id}/sites")
-            response.raise_for_status()
-            sites = response.json()["sites"]
-            return sites
-        except requests.RequestException as e:
-            raise Exception("Failed to get sites from Laravel Forge API") from e
+        response = self._request("GET", f"/servers/{server_id}/sites", op="get sites")
+        return rjson(response)["sites"]
+
+    @_view_of("get_all_sites")
+    def get_all_sites_by_name(self, sites):
+        return {site["name"]: site for site in sites}
 
     def get_site_by_id(self, server_id, site_id):
-        try:
-            res = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}"
-            )
-            res.raise_for_status()
-            return res.json()["site"]
-        except requests.RequestException as e:
-            raise Exception("Failed to get site from Laravel Forge API") from e
+        response = self._request(
+            "GET", f"/servers/{server_id}/sites/{site_id}", op="get site"
+        )
+        return rjson(response)["site"]
 
     def update_site(self, server_id, site_id, **kwargs):
-        try:
-            response = self.session.put(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}",
-                json={**kwargs},
-            )
-            response.raise_for_status()
-            return response.json()["site"]
-        except requests.RequestException as e:
-            raise Exception("Failed to update site from Laravel Forge API") from e
+        response = self._request(
+            "PUT",
+            f"/servers/{server_id}/sites/{site_id}",
+            op="update site",
+            json={**kwargs},
+        )
+        self.invalidate("get_all_sites")
+        return rjson(response)["site"]
+
+    def delete_site(self, server_id, site_id):
+        self._request(
+            "DELETE", f"/servers/{server_id}/sites/{site_id}", op="delete site"
+        )
+        self.invalidate("get_all_sites")
+
+    def install_repository(self, server_id, site_id, payload):
+        response = self._request(
+            "POST",
+            f"/servers/{server_id}/sites/{site_id}/git",
+            op="install repository",
+            json=payload,
+        )
+        self.invalidate("get_all_sites")
+        return rjson(response)["site"]
+
+    def update_php_version(self, server_id, site_id, version):
+        self._request(
+            "PUT",
+            f"/servers/{server_id}/sites/{site_id}/php",
+            op="update site php version",
+            json={"version": version},
+        )
+        self.invalidate("get_all_sites")
+
+    def get_deployment_script(self, server_id, site_id):
+        response = self._request(
+            "GET",
+            f"/servers/{server_id}/sites/{site_id}/deployment/script",
+            op="get deployment script",
+        )
+        return response.content.decode("utf-8")
+
+    def get_env(self, server_id, site_id):
+        response = self._request(
+            "GET", f"/servers/{server_id}/sites/{site_id}/env", op="get site env"
+        )
+        return response.content.decode("utf-8")
+
+    def set_env(self, server_id, site_id, content):
+        self._request(
+            "PUT",
+            f"/servers/{server_id}/sites/{site_id}/env",
+            op="set site env",
+            json={"content": content},
+        )
+
+    # --- Deployments ---
+
+    def set_deployment_script(self, server_id, site_id, content, auto_source=False):
+        self._request(
+            "PUT",
+            f"/servers/{server_id}/sites/{site_id}/deployment/script",
+            op="set deployment script",
+            json={"content": content, "auto_source": auto_source},
+        )
+
+    def deploy_site(self, server_id, site_id):
+        response = self._request(
+            "POST",
+            f"/servers/{server_id}/sites/{site_id}/deployment/deploy",
+            op="deploy site",
+        )
+        return rjson(response)["site"]
+
+    def get_deployment_log(self, server_id, site_id):
+        """Get the last deployment log, None if the site has no deployment log."""
+        response = self._request(
+            "GET",
+            f"/servers/{server_id}/sites/{site_id}/deployment/log",
+            op="get deployment log",
+            allow_missing=True,
+        )
+        if response is None:
+            return None
+        response.encoding = "utf-8"
+        return response.text
+
+    def get_deployment_history(self, server_id, site_id):
+        response = self._request(
+            "GET",
+            f"/servers/{server_id}/sites/{site_id}/deployment-history",
+            op="get deployment history",
+        )
+        return rjson(response)["deployments"]
 
     # --- nginx ---
 
+    @_cached(ttl=30)
     def get_nginx_templates(self, server_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/nginx/templates"
-            )
-            response.raise_for_status()
-            return response.json()["templates"]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to get nginx templates from Laravel Forge API"
-            ) from e
+        response = self._request(
+            "GET", f"/servers/{server_id}/nginx/templates", op="get nginx templates"
+        )
+        return rjson(response)["templates"]
 
     def create_nginx_template(self, server_id, name, content):
-        try:
-            response = self.session.post(
-                f"{self.forge_uri}/servers/{server_id}/nginx/templates",
-                json={
-                    "content": content,
-                    "name": name,
-                },
-            )
-            response.raise_for_status()
-            return response.json()["template"]["id"]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to create nginx template from Laravel Forge API"
-            ) from e
+        response = self._request(
+            "POST",
+            f"/servers/{server_id}/nginx/templates",
+            op="create nginx template",
+            json={
+                "content": content,
+                "name": name,
+            },
+        )
+        self.invalidate("get_nginx_templates")
+        return rjson(response)["template"]["id"]
 
     def get_nginx_template_by_id(self, server_id, template_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/nginx/templates/{template_id}"
-            )
-            response.raise_for_status()
-            return response.json()["template"]["content"]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to get nginx template by id from Laravel Forge API"
-            ) from e
+        response = self._request(
+            "GET",
+            f"/servers/{server_id}/nginx/templates/{template_id}",
+            op="get nginx template by id",
+        )
+        return rjson(response)["template"]["content"]
 
-    def get_nginx_config(self, server_id, site_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/nginx"
-            )
-            response.raise_for_status()
-            return response.content.decode("utf-8")
+    def update_nginx_template(self, server_id, template_id, content):
+        self._request(
+            "PUT",
+            f"/servers/{server_id}/nginx/templates/{template_id}",
+            op="update nginx template",
+            json={"content": content},
+        )
 
-        except requests.RequestException as e:
-            raise Exception("Failed to get nginx config from Laravel Forge API") from e
+    def get_nginx_config(self, server_id, site_id):
+        response = self._request(
+            "GET", f"/servers/{server_id}/sites/{site_id}/nginx", op="get nginx config"
+        )
+        # set the encoding so requests doesn't run charset detection on the body
+        response.encoding = "utf-8"
+        return response.text
 
     def set_nginx_config(self, server_id, site_id, nginx_config):
-        try:
-            response = self.session.put(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/nginx",
-                json={"content": nginx_config},
-            )
-            response.raise_for_status()
-        except requests.RequestException as e:
-            raise Exception("Failed to set nginx config from Laravel Forge API") from e
+        self._request(
+            "PUT",
+            f"/servers/{server_id}/sites/{site_id}/nginx",
+            op="set nginx config",
+            json={"content": nginx_config},
+        )
 
     # --- Certificates ---
 
+    @_cached(ttl=30)
     def list_certificates(self, server_id, site_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/certificates"
-            )
-            response.raise_for_status()
-            return response.json()["certificates"]
-        except requests.RequestException as e:
-            raise Exception("Failed to list certificates from Laravel Forge API") from e
+        response = self._request(
+            "GET",
+            f"/servers/{server_id}/sites/{site_id}/certificates",
+            op="list certificates",
+        )
+        return rjson(response)["certificates"]
 
     def get_certificate_by_id(self, server_id, site_id, certificate_id):
-        try:
-            response = self.session.get(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/certificates/{certificate_id}"
-            )
-            response.raise_for_status()
-            return response.json()["certificate"]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to get certificate by id from Laravel Forge API"
-            ) from e
+        response = self._request(
+            "GET",
+            f"/servers/{server_id}/sites/{site_id}/certificates/{certificate_id}",
+            op="get certificate by id",
+        )
+        return rjson(response)["certificate"]
 
     def activate_certificate(self, server_id, site_id, certificate_id):
-        try:
-            response = self.session.post(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/certificates/{certificate_id}/activate"
-            )
-            response.raise_for_status()
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to activate certificate from Laravel Forge API"
-            ) from e
+        self._request(
+            "POST",
+            f"/servers/{server_id}/sites/{site_id}/certificates/{certificate_id}/activate",
+            op="activate certificate",
+        )
+        self.invalidate("list_certificates")
 
     def create_certificate(self, server_id, site_id, domains):
-        try:
-            response = self.session.post(
-                f"{self.forge_uri}/servers/{server_id}/sites/{site_id}/certificates/letsencrypt",
-                json={"domains": domains},
-            )
-            response.raise_for_status()
-            return response.json()["certificate"]
-        except requests.RequestException as e:
-            raise Exception(
-                "Failed to create certificate from Laravel Forge API"
-            ) from e
+        response = self._request(
+            "POST",
+            f"/servers/{server_id}/sites/{site_id}/certificates/letsencrypt",
+            op="create certificate",
+            json={"domains": domains},
+        )
+        self.invalidate("list_certificates")
+        return rjson(response)["certificate"]
 
     # ------------ Php ------------
 
     def get_server_installed_php_versions(self, server_id):
-        try:
-            res = self.session.get(f"{self.forge_uri}/servers/{server_id}/php")
-            res.raise_for_status()
-            return res.json()
-        except requests.RequestException as e:
-            raise Exception("Failed to get installed PHP versions") from e
+        response = self._request(
+            "GET", f"/servers/{server_id}/php", op="get installed PHP versions"
+        )
+        return rjson(response)
 
     def install_php_version(self, server_id, version):
-        try:
-            response = self.session.post(
-                f"{self.forge_uri}/servers/{server_id}/php",
-                json={"version": version},
-            )
-            response.raise_for_status()
-        except requests.RequestException as e:
-            raise Exception("Failed to install PHP version") from e
+        self._request(
+            "POST",
+            f"/servers/{server_id}/php",
+            op="install PHP version",
+            json={"version": version},
+        )
+
+    # ------------ Daemons ------------
+
+    @_cached(ttl=30)
+    def list_daemons(self, server_id):
+        response = self._request(
+            "GET", f"/servers/{server_id}/daemons", op="list daemons"
+        )
+        return rjson(response)["daemons"]
+
+    @_view_of("list_daemons")
+    def list_daemons_by_directory(self, daemons):
+        daemons_by_dir = {}
+        for daemon in daemons:
+            daemons_by_dir.setdefault(daemon["directory"], []).append(daemon)
+        return daemons_by_dir
+
+    def create_daemon(self, server_id, payload):
+        response = self._request(
+            "POST", f"/servers/{server_id}/daemons", op="create daemon", json=payload
+        )
+        self.invalidate("list_daemons")
+        return rjson(response)["daemon"]
+
+    def delete_daemon(self, server_id, daemon_id):
+        self._request(
+            "DELETE", f"/servers/{server_id}/daemons/{daemon_id}", op="delete daemon"
+        )
+        self.invalidate("list_daemons")
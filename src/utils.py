@@ -1,67 +1,104 @@
+import copy
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import random
 import re
+import tempfile
 import time
-from pathlib import Path
 
-from cerberus import Validator
+import orjson
 
-from schema import schema
+logger = logging.getLogger(__name__)
+
+
+@functools.cache
+def _validator():
+    # cerberus is only imported when a config is validated, a cached config skips it
+    from cerberus import Validator
+
+    from schema import schema
+
+    return Validator(schema)  # type: ignore
 
 
 def validate_yaml_data(data):
-    v = Validator(schema)  # type: ignore
-    if not v.validate(data):  # type: ignore
-        raise Exception(f"YAML data validation failed: {v.errors}")  # type: ignore
+    validator = _validator()
+    if not validator.validate(data):  # type: ignore
+        raise Exception(f"YAML data validation failed: {validator.errors}")  # type: ignore
+
+
+# matches all occurrences of secrets in the form ${{ secrets.SECRET_VAR }}
+_SECRET_RE = re.compile(r"\$\{\{\s*secrets\.(\w+)\s*\}\}")
+# matches nginx template variables in the form {{ VARIABLE_NAME }}
+_NGINX_VAR_RE = re.compile(r"{{(.*?)}}")
+
+
+def _replace_secret(secrets, match):
+    secret_name = match.group(1).upper()
+    if secret_name not in secrets:
+        raise ValueError(f"Secret '{secret_name}' value is not set.")
+    return secrets[secret_name]
+
+
+def _replace_nginx_variable(variables, match):
+    var_name = match.group(1).strip()
+
+    try:
+        var_value = variables[var_name]
+    except KeyError:
+        raise ValueError(f"Variable '{var_name}' value is not set.")
+
+    return str(var_value)
 
 
 def replace_secrets_yaml(data, secrets):
+    # containers are only copied when one of their children was replaced
     if isinstance(data, dict):
-        return {
-            key: replace_secrets_yaml(value, secrets) for key, value in data.items()
-        }
+        replaced = None
+        for key, value in data.items():
+            new_value = replace_secrets_yaml(value, secrets)
+            if new_value is not value:
+                if replaced is None:
+                    replaced = dict(data)
+                replaced[key] = new_value
+        return data if replaced is None else replaced
     elif isinstance(data, list):
-        return [replace_secrets_yaml(item, secrets) for item in data]
+        replaced = None
+        for i, item in enumerate(data):
+            new_item = replace_secrets_yaml(item, secrets)
+            if new_item is not item:
+                if replaced is None:
+                    replaced = list(data)
+                replaced[i] = new_item
+        return data if replaced is None else replaced
     elif isinstance(data, str):
-        # regex matches all occurrences of secrets in the form ${{ secrets.SECRET_VAR }}
-        pattern = re.compile(r"\$\{\{\s*secrets\.(\w+)\s*\}\}")
-
-        def replace_match(match):
-            secret_name = match.group(1).upper()
-            if secret_name not in secrets:
-                raise ValueError(f"Secret '{secret_name}' value is not set.")
-            return secrets[secret_name]
-
-        return pattern.sub(replace_match, data)
+        if "${{" not in data:
+            return data
+        return _SECRET_RE.sub(functools.partial(_replace_secret, secrets), data)
     else:
         return data
 
 
 def replace_nginx_variables(nginx_conf, variables):
-    pattern = re.compile(r"{{(.*?)}}")
-
-    def replace_match(match):
-        var_name = match.group(1).strip()
-
-        try:
-            var_value = variables[var_name]
-        except KeyError:
-            raise ValueError(f"Variable '{var_name}' value is not set.")
-
-        return str(var_value)
-
-    return pattern.sub(replace_match, nginx_conf)
+    return _NGINX_VAR_RE.sub(
+        functools.partial(_replace_nginx_variable, variables), nginx_conf
+    )
 
 
-def wait(callback, max_retries=8):
+def wait(callback, max_retries=12, min_interval=1.0, max_interval=15.0, factor=1.5):
     retries = 0
-    timeout = 0.5
-    max_timeout = 30
+    interval = min_interval
     # max_retries < 0 means infinite retries
     while max_retries < 0 or retries <= max_retries:
         if callback():
             return True
-        time.sleep(timeout)
+        # exponential backoff with jitter so concurrent pollers don't sync up
+        time.sleep(min(interval * (1 + random.random() * 0.5), max_interval))
         retries += 1
-        timeout = min(timeout * 2, max_timeout)
+        interval = min(interval * factor, max_interval)
     return False
 
 
@@ -69,26 +106,49 @@ def parse_env(env: str | None) -> dict:
     if not env:
         return {}
     parsed_env = {}
-    for line in env.strip().split("\n"):
-        if line:
-            try:
-                key, value = line.split("=", 1)
-                parsed_env[key.strip().upper()] = value.strip()
-            except ValueError:
-                print(
-                    f"Error: Could not parse line: '{line}'. Make sure each line has a key and a value separated by '='."
-                )
+    for line in env.split("\n"):
+        key, sep, value = line.partition("=")
+        if sep:
+            parsed_env[key.strip().upper()] = value.strip()
+        elif line.strip():
+            logger.warning(
+                "Could not parse line: '%s'. Make sure each line has a key and a value separated by '='.",
+                line,
+            )
     return parsed_env
 
 
+def read_file(path) -> str:
+    """Read a file as bytes and decode it once as utf-8."""
+    with open(path, "rb") as file:
+        return file.read().decode("utf-8")
+
+
 def cat_paths(*paths):
-    return str(Path(*paths))
+    return os.path.join(*paths)
 
 
 def ensure_relative_path(path: str | None):
-    if path and path.startswith("/"):
-        return "." + path
-    return path
+    return "." + path if path and path[0] == "/" else path
+
+
+# values of the optional site keys when they are missing from the yaml
+_SITE_DEFAULTS = {
+    "root_dir": ".",
+    "web_dir": "public",
+    "project_type": "html",
+    "php_version": None,
+    "deployment_commands": None,
+    "daemons": [],
+    "environment": None,
+    "env_file": None,
+    "aliases": [],
+    "nginx_template": "default",
+    "nginx_template_variables": {},
+    "nginx_custom_config": None,
+    "certificate": False,
+    "clone_repository": True,
+}
 
 
 def load_config(yaml_data):
@@ -99,35 +159,80 @@ def load_config(yaml_data):
         "sites": [],
     }
     for site in yaml_data.get("sites", []):
-
-        config["sites"].append(
-            {
-                "site_domain": site["site_domain"],
-                "root_dir": ensure_relative_path(site.get("root_dir", ".")),
-                "web_dir": ensure_relative_path(site.get("web_dir", "public")),
-                "project_type": site.get("project_type", "html"),
-                "php_version": site.get("php_version", None),
-                "deployment_commands": site.get("deployment_commands", None),
-                "daemons": site.get("daemons", []),
-                "environment": site.get("environment", None),
-                "env_file": ensure_relative_path(site.get("env_file", None)),
-                "aliases": site.get("aliases", []),
-                "nginx_template": site.get("nginx_template", "default"),
-                "nginx_template_variables": site.get("nginx_template_variables", {}),
-                "nginx_custom_config": ensure_relative_path(
-                    site.get("nginx_custom_config")
-                ),
-                "certificate": site.get("certificate", False),
-                "clone_repository": site.get("clone_repository", True),
-            }
-        )
+        # fresh copies so sites never share the default lists and dicts
+        site_config = {**copy.deepcopy(_SITE_DEFAULTS), **site}
+        for key in ("root_dir", "web_dir", "env_file", "nginx_custom_config"):
+            site_config[key] = ensure_relative_path(site_config[key])
+        config["sites"].append(site_config)
     return config
 
 
+def get_site_dir(site_conf) -> str:
+    """Get the directory of the site code on the forge server."""
+    path = os.path.join("/home/forge", site_conf["site_domain"], site_conf["root_dir"])
+    # drop the empty and `.` segments like pathlib does, `..` is kept as is
+    return "/" + "/".join(part for part in path.split("/") if part not in ("", "."))
+
+
 def get_domains_certificate(certificates, domains) -> dict | None:
     """Get the certificate for the given domains from the list of certificates."""
+    domains = frozenset(domains)
     for cert in certificates:
-        cert_domains = cert["domain"].split(",")
-        if set(cert_domains) == set(domains):
+        if frozenset(cert["domain"].split(",")) == domains:
             return cert
     return None
+
+
+def content_hash(content: str) -> str:
+    """Get a short stable digest of the content, used to compare contents."""
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def rjson(response):
+    """Decode the JSON body of a response with orjson."""
+    return orjson.loads(response.content)
+
+
+def load_cached_config(cache_path):
+    """Load a config stored with `store_cached_config`, None if it isn't cached."""
+    try:
+        with open(cache_path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        # an unreadable cache file is a miss, the config is parsed and stored again
+        logger.warning("Ignoring unreadable config cache `%s`", cache_path)
+        return None
+
+
+def store_cached_config(cache_path, config):
+    """Pickle the config to `cache_path`, the file is replaced atomically.
+
+    The other configs cached in the same directory are removed, they hold secrets
+    that may be outdated. Failing to write the cache only logs a warning.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # mkstemp makes the file private to the current user, the config holds secrets
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(config, file)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logger.warning("Could not store the config cache `%s`: %s", cache_path, e)
+        return
+
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".pkl") and entry.name != os.path.basename(cache_path):
+            try:
+                os.unlink(entry.path)
+            except OSError as e:
+                logger.warning(
+                    "Could not remove stale config cache `%s`: %s", entry.path, e
+                )
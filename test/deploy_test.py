@@ -1,16 +1,30 @@
+import hashlib
 import os
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
 import pytest
 import requests
+import responses
 import yaml
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 from forge_api import ForgeApi
-from utils import cat_paths, get_domains_certificate, load_config, parse_env
+from utils import (
+    cat_paths,
+    get_domains_certificate,
+    get_site_dir,
+    load_config,
+    parse_env,
+    read_file,
+    rjson,
+)
 
 load_dotenv(".env.test")
 
@@ -25,6 +39,8 @@ FORGE_API_TOKEN = os.getenv("FORGE_API_TOKEN")
 WORKFLOW_REPO_PATH = os.path.dirname(__file__)
 FRESH_DEPLOYMENT_FILE = "forge-deploy.test.yml"
 SECOND_DEPLOYMENT_FILE = "forge-deploy2.test.yml"
+# (connect, read) timeout of the requests sent directly by the test
+HTTP_TIMEOUT = (3.05, 10)
 
 # Test server name
 test_server_name = "devops-tst"
@@ -40,11 +56,30 @@ session.headers.update(
 
 forge_api = ForgeApi(session)
 
+# keep-alive session for the deployed sites, separate from the forge session so
+# the api token is never sent to them
+site_session = requests.sessions.Session()
+site_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    ),
+)
+site_session.mount("https://", site_adapter)
+site_session.mount("http://", site_adapter)
+
+# shared by the validations to send their independent requests concurrently
+executor = ThreadPoolExecutor(max_workers=8)
+
 
 def get_server_id():
-    response = session.get(f"{FORGE_API_URL}/servers")
+    response = session.get(f"{FORGE_API_URL}/servers", timeout=HTTP_TIMEOUT)
     response.raise_for_status()
-    servers = response.json()["servers"]
+    servers = rjson(response)["servers"]
     server = next(
         (server for server in servers if server["name"] == test_server_name), None
     )
@@ -54,16 +89,21 @@ def get_server_id():
 
 def load_deployment_config(dep_file):
     dep_file_path = cat_paths(WORKFLOW_REPO_PATH, dep_file)
-    with open(dep_file_path, "r") as file:
-        yaml_data = yaml.safe_load(file)
-        return load_config(yaml_data)
+    yaml_data = yaml.safe_load(read_file(dep_file_path))
+    return load_config(yaml_data)
 
 
 def get_site(server_id, domain):
-    response = session.get(f"{FORGE_API_URL}/servers/{server_id}/sites")
-    response.raise_for_status()
-    sites = response.json()["sites"]
-    return next((site for site in sites if site["name"] == domain), None)
+    return forge_api.get_all_sites_by_name(server_id).get(domain)
+
+
+def probe_site(url):
+    # HEAD skips the page body, fall back to GET for servers that don't allow it
+    response = site_session.head(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
+    if response.status_code == 405:
+        response = site_session.get(url, stream=True, timeout=HTTP_TIMEOUT)
+        response.close()
+    return response
 
 
 def validate_site_configuration(server_id, site_config):
@@ -74,11 +114,13 @@ def validate_site_configuration(server_id, site_config):
 
     # Validate site web directory
     site_dir = site["web_directory"]
-    expected_dir = cat_paths(
-        "/home/forge/",
-        site_config["site_domain"],
-        site_config["root_dir"],
-        site_config["web_dir"],
+    expected_dir = os.path.normpath(
+        cat_paths(
+            "/home/forge/",
+            site_config["site_domain"],
+            site_config["root_dir"],
+            site_config["web_dir"],
+        )
     )
     assert (
         site_dir == expected_dir
@@ -99,156 +141,345 @@ def validate_site_configuration(server_id, site_config):
             f"Expected: {site_config['php_version']}, Found: {site['php_version']}"
         )
 
-    # Validate environment variables
-    response = session.get(
-        f"{FORGE_API_URL}/servers/{server_id}/sites/{site['id']}/env"
-    )
-    response.raise_for_status()
-    env_content = response.content.decode("utf-8")
-    expected_env = {}
-    expected_env_str = ""
-    if site_config.get("env_file"):
-        env_file_path = cat_paths(WORKFLOW_REPO_PATH, site_config["env_file"])
-        with open(env_file_path, "r") as file:
-            file_env = parse_env(file.read())
-            expected_env.update(file_env)
-    expected_env.update(parse_env(site_config.get("environment", "")))
-    expected_env_str += "\n".join([f"{k}={v}" for k, v in expected_env.items()])
-
-    assert (
-        expected_env_str == env_content
-    ), f"Environment variable mismatch for site {site_config['site_domain']}."
-
-    # Validate deployment script
+    # the checks below only read independent resources, fetch them concurrently
+    site_url = f"{FORGE_API_URL}/servers/{server_id}/sites/{site['id']}"
+    env_future = executor.submit(session.get, f"{site_url}/env", timeout=HTTP_TIMEOUT)
+    script_future = nginx_future = certs_future = None
     if site_config.get("deployment_commands"):
-        response = session.get(
-            f"{FORGE_API_URL}/servers/{server_id}/sites/{site['id']}/deployment/script",
+        script_future = executor.submit(
+            session.get, f"{site_url}/deployment/script", timeout=HTTP_TIMEOUT
         )
-        response.raise_for_status()
-        deployment_script = response.content.decode("utf-8")
-        expected_commands = site_config.get("deployment_commands")
-        assert (
-            expected_commands in deployment_script
-        ), f"Deployment script for site '{site_config['site_domain']}' does not match expected commands."
-
-    # Validate custom nginx config
     if site_config.get("nginx_custom_config"):
-        response = session.get(
-            f"{FORGE_API_URL}/servers/{server_id}/sites/{site['id']}/nginx",
+        nginx_future = executor.submit(
+            session.get, f"{site_url}/nginx", timeout=HTTP_TIMEOUT
         )
-        response.raise_for_status()
-        nginx_config = response.content.decode("utf-8")
-        expected_nginx_config = cat_paths(
-            WORKFLOW_REPO_PATH, site_config["nginx_custom_config"]
+    daemons_future = executor.submit(forge_api.list_daemons_by_directory, server_id)
+    if site_config.get("certificate"):
+        certs_future = executor.submit(
+            forge_api.list_certificates, server_id, site["id"]
         )
-        with open(expected_nginx_config, "r") as file:
-            expected_nginx_config = file.read()
-        assert (
-            nginx_config == expected_nginx_config
-        ), f"Custom nginx config for site '{site_config['site_domain']}' does not match expected config."
-
-    # Validate daemons
-    response = session.get(f"{FORGE_API_URL}/servers/{server_id}/daemons")
-    response.raise_for_status()
-    daemons = response.json()["daemons"]
-    site_dir = str(
-        Path("/home/forge/") / site_config["site_domain"] / site_config["root_dir"]
+    site_up_future = executor.submit(
+        probe_site,
+        f"{"https" if site["is_secured"] else "http"}://{site_config['site_domain']}",
     )
-    site_daemons = [daemon for daemon in daemons if daemon["directory"] == site_dir]
-    configured_daemons = [
-        daemon["command"] for daemon in site_config.get("daemons", [])
+
+    # don't leave requests in flight when a check fails
+    pending = [
+        future
+        for future in (
+            env_future,
+            script_future,
+            nginx_future,
+            daemons_future,
+            certs_future,
+            site_up_future,
+        )
+        if future is not None
     ]
-    for daemon in site_daemons:
+    try:
+        # Validate environment variables
+        response = env_future.result()
+        response.raise_for_status()
+        file_env = {}
+        if site_config.get("env_file"):
+            env_file_path = cat_paths(WORKFLOW_REPO_PATH, site_config["env_file"])
+            file_env = parse_env(read_file(env_file_path))
+        # environment from the config takes precedence over the env file
+        expected_env = {**file_env, **parse_env(site_config.get("environment", ""))}
+        expected_env_hash = hashlib.blake2b(
+            "\n".join(f"{k}={v}" for k, v in expected_env.items()).encode()
+        ).digest()
+
         assert (
-            daemon["command"] in configured_daemons
-        ), f"Daemon '{daemon['command']}' is missing or not properly configured for site '{site_config['site_domain']}'."
+            expected_env_hash == hashlib.blake2b(response.content).digest()
+        ), f"Environment variable mismatch for site {site_config['site_domain']}."
 
-    # Validate SSL certificate
-    if site_config.get("certificate"):
-        site_certs = forge_api.list_certificates(server_id, site["id"])
-        site_certificate = get_domains_certificate(
-            site_certs, [site_config["site_domain"], *site_config["aliases"]]
-        )
+        # Validate deployment script
+        if site_config.get("deployment_commands"):
+            response = script_future.result()
+            response.raise_for_status()
+            deployment_script = response.content.decode("utf-8")
+            expected_commands = site_config.get("deployment_commands")
+            assert (
+                expected_commands in deployment_script
+            ), f"Deployment script for site '{site_config['site_domain']}' does not match expected commands."
+
+        # Validate custom nginx config
+        if site_config.get("nginx_custom_config"):
+            response = nginx_future.result()
+            response.raise_for_status()
+            nginx_config = response.content.decode("utf-8")
+            expected_nginx_config = read_file(
+                cat_paths(WORKFLOW_REPO_PATH, site_config["nginx_custom_config"])
+            )
+            assert (
+                nginx_config == expected_nginx_config
+            ), f"Custom nginx config for site '{site_config['site_domain']}' does not match expected config."
+
+        # Validate daemons
+        daemons_by_dir = daemons_future.result()
+        site_dir = get_site_dir(site_config)
+        configured_daemons = {
+            daemon["command"] for daemon in site_config.get("daemons", [])
+        }
+        for daemon in daemons_by_dir.get(site_dir, []):
+            assert (
+                daemon["command"] in configured_daemons
+            ), f"Daemon '{daemon['command']}' is missing or not properly configured for site '{site_config['site_domain']}'."
+
+        # Validate SSL certificate
+        if site_config.get("certificate"):
+            site_certs = certs_future.result()
+            site_certificate = get_domains_certificate(
+                site_certs, [site_config["site_domain"], *site_config["aliases"]]
+            )
+
+            assert (
+                site["is_secured"] and site_certificate and site_certificate["active"]
+            ), f"Site '{site['name']}' is not secured"
 
+        # curl site to check if it is up
+        response = site_up_future.result()
         assert (
-            site["is_secured"] and site_certificate and site_certificate["active"]
-        ), f"Site '{site['name']}' is not secured"
+            response.status_code == 200
+        ), f"Site '{site_config['site_domain']}' is down"
+    finally:
+        wait(pending)
 
-    # curl site to check if it is up
-    response = requests.get(
-        f"{"https" if site["is_secured"] else "http"}://{site_config['site_domain']}"
-    )
-    assert response.status_code == 200, f"Site '{site_config['site_domain']}' is down"
+
+def validate_sites(server_id, deployment_config):
+    # warm the server listings first, the deployment dropped them from the cache and
+    # concurrent validations would each send their own request otherwise
+    forge_api.get_all_sites_by_name(server_id)
+    forge_api.list_daemons_by_directory(server_id)
+
+    # the validations wait on the shared executor, run them on a pool of their own
+    with ThreadPoolExecutor(max_workers=8) as sites_executor:
+        futures = [
+            sites_executor.submit(validate_site_configuration, server_id, site_config)
+            for site_config in deployment_config.get("sites", [])
+        ]
+        for future in futures:
+            future.result()
 
 
 def run_deployment_script(dep_file):
-    subprocess.run(
-        [sys.executable, "src/deploy.py"],
-        check=True,
-        env={  # type: ignore
-            "DEBUG": "true",
-            "GITHUB_WORKSPACE": WORKFLOW_REPO_PATH,  # GITHUB WORKSPACE is root path where the code lives
-            "DEPLOYMENT_FILE": dep_file,
-            "FORGE_API_TOKEN": FORGE_API_TOKEN,
-        },
-    )
+    try:
+        subprocess.run(
+            [sys.executable, "src/deploy.py"],
+            check=True,
+            env={  # type: ignore
+                "DEBUG": "true",
+                "GITHUB_WORKSPACE": WORKFLOW_REPO_PATH,  # GITHUB WORKSPACE is root path where the code lives
+                "DEPLOYMENT_FILE": dep_file,
+                "FORGE_API_TOKEN": FORGE_API_TOKEN,
+            },
+        )
+    finally:
+        # the deployment changed the server, drop responses cached before it
+        forge_api.invalidate()
 
 
 def cleanup_sites_and_daemons(server_id, deployment_config):
+    # daemons are listed per server, fetch them once grouped by directory
+    daemons_by_dir = forge_api.list_daemons_by_directory(server_id)
+
+    sites = []
+    daemon_futures = []
     for site_config in deployment_config.get("sites", []):
         site = get_site(server_id, site_config["site_domain"])
         if site:
-            site_id = site["id"]
-
-            # Delete daemons
-            response = session.get(f"{FORGE_API_URL}/servers/{server_id}/daemons")
-            response.raise_for_status()
-            daemons = response.json()["daemons"]
-            site_dir = cat_paths(
-                "/home/forge/", site_config["site_domain"], site_config["root_dir"]
-            )
-            site_daemons = [
-                daemon for daemon in daemons if daemon["directory"] == site_dir
-            ]
-            for daemon in site_daemons:
-                response = session.delete(
-                    f"{FORGE_API_URL}/servers/{server_id}/daemons/{daemon['id']}",
-                )
-                response.raise_for_status()
-
-            # Delete site
-            response = session.delete(
-                f"{FORGE_API_URL}/servers/{server_id}/sites/{site_id}"
+            sites.append(site)
+            site_dir = get_site_dir(site_config)
+            daemon_futures.extend(
+                executor.submit(forge_api.delete_daemon, server_id, daemon["id"])
+                for daemon in daemons_by_dir.get(site_dir, [])
             )
-            response.raise_for_status()
 
+    # the daemons must be gone before their sites are deleted
+    for future in daemon_futures:
+        future.result()
+
+    site_futures = [
+        executor.submit(forge_api.delete_site, server_id, site["id"]) for site in sites
+    ]
+    for future in site_futures:
+        future.result()
 
-@pytest.fixture(scope="module")
+
+@pytest.fixture(scope="session", autouse=True)
+def http_clients():
+    yield
+    # release the pooled connections and worker threads once the run is over
+    executor.shutdown()
+    site_session.close()
+    session.close()
+
+
+@pytest.fixture(scope="session")
 def server_id():
     return get_server_id()
 
 
-@pytest.fixture(scope="module")
+@pytest.fixture(scope="session")
 def fresh_deployment_config():
     return load_deployment_config(FRESH_DEPLOYMENT_FILE)
 
 
-@pytest.fixture(scope="module")
+@pytest.fixture(scope="session")
 def second_deployment_config():
     return load_deployment_config(SECOND_DEPLOYMENT_FILE)
 
 
+@pytest.fixture
+def forge_mock():
+    with responses.RequestsMock() as mock:
+        yield mock
+    # don't leak the mocked listings to other tests
+    forge_api.invalidate()
+
+
+def mock_unit_site(forge_mock, server_id, env):
+    """Mock the Forge API and the site for a `unit.test` site, return its config."""
+    site_url = f"{FORGE_API_URL}/servers/{server_id}/sites/2"
+    forge_mock.get(
+        f"{FORGE_API_URL}/servers/{server_id}/sites",
+        json={
+            "sites": [
+                {
+                    "id": 2,
+                    "name": "unit.test",
+                    "web_directory": "/home/forge/unit.test/public",
+                    "aliases": [],
+                    "is_secured": False,
+                }
+            ]
+        },
+    )
+    forge_mock.get(f"{site_url}/env", body=env)
+    forge_mock.get(
+        f"{FORGE_API_URL}/servers/{server_id}/daemons",
+        json={
+            "daemons": [
+                {
+                    "id": 3,
+                    "directory": "/home/forge/unit.test",
+                    "command": "php artisan queue:work",
+                }
+            ]
+        },
+    )
+    forge_mock.head("http://unit.test")
+
+    return load_config(
+        {
+            "server_name": test_server_name,
+            "github_repository": "the-trybe/forge-deployment-scripts",
+            "sites": [
+                {
+                    "site_domain": "unit.test",
+                    "environment": "APP_ENV=testing\nAPP_DEBUG=false",
+                    "daemons": [{"command": "php artisan queue:work"}],
+                }
+            ],
+        }
+    )["sites"][0]
+
+
+def test_validate_site_configuration_unit(forge_mock):
+    site_config = mock_unit_site(forge_mock, 1, "APP_ENV=testing\nAPP_DEBUG=false")
+
+    validate_site_configuration(1, site_config)
+
+
+def test_validate_site_configuration_env_mismatch_unit(forge_mock):
+    site_config = mock_unit_site(forge_mock, 1, "APP_ENV=production\nAPP_DEBUG=false")
+
+    with pytest.raises(AssertionError, match="Environment variable mismatch"):
+        validate_site_configuration(1, site_config)
+
+
+def test_load_config_defaults_not_shared():
+    yaml_data = {
+        "server_name": test_server_name,
+        "github_repository": "the-trybe/forge-deployment-scripts",
+        "sites": [{"site_domain": "a.test"}, {"site_domain": "b.test"}],
+    }
+    first, second = load_config(yaml_data)["sites"]
+    first["daemons"].append({"command": "php artisan queue:work"})
+    first["nginx_template_variables"]["PORT"] = "3000"
+
+    assert second["daemons"] == [] and second["nginx_template_variables"] == {}
+    assert load_config(yaml_data)["sites"][0]["daemons"] == []
+
+
+def test_get_site_dir_matches_pathlib():
+    for root_dir in (".", "./", "./app", "./app/", "./a/./b", "../x", "./a/../b"):
+        site_conf = {"site_domain": "unit.test", "root_dir": root_dir}
+        expected = str(Path("/home/forge/") / "unit.test" / root_dir)
+        assert get_site_dir(site_conf) == expected, root_dir
+
+
+def test_forge_api_listing_memoized_unit(forge_mock):
+    api = ForgeApi(requests.sessions.Session())
+    sites = forge_mock.get(
+        f"{FORGE_API_URL}/servers/1/sites",
+        json={"sites": [{"id": 2, "name": "unit.test"}]},
+    )
+
+    assert api.get_all_sites(1) is api.get_all_sites(1)
+    by_name = api.get_all_sites_by_name(1)
+    assert by_name is api.get_all_sites_by_name(1)
+    assert by_name["unit.test"]["id"] == 2
+    assert sites.call_count == 1
+
+
+def test_forge_api_write_invalidates_listing_and_view_unit(forge_mock):
+    api = ForgeApi(requests.sessions.Session())
+    url = f"{FORGE_API_URL}/servers/1/daemons"
+    daemon = {"id": 3, "directory": "/home/forge/unit.test", "command": "a"}
+    forge_mock.get(url, json={"daemons": []})
+    forge_mock.post(url, json={"daemon": daemon})
+    forge_mock.delete(f"{url}/3")
+
+    assert api.list_daemons_by_directory(1) == {}
+
+    api.create_daemon(1, {"command": "a", "directory": daemon["directory"]})
+    forge_mock.replace(responses.GET, url, json={"daemons": [daemon]})
+    assert api.list_daemons_by_directory(1) == {daemon["directory"]: [daemon]}
+    assert api.list_daemons(1) == [daemon]
+
+    api.delete_daemon(1, 3)
+    forge_mock.replace(responses.GET, url, json={"daemons": []})
+    assert api.list_daemons_by_directory(1) == {}
+    assert api.list_daemons(1) == []
+
+
+def test_forge_api_refetched_listing_rebuilds_view_unit(forge_mock, monkeypatch):
+    api = ForgeApi(requests.sessions.Session())
+    url = f"{FORGE_API_URL}/servers/1/sites"
+    forge_mock.get(url, json={"sites": [{"id": 2, "name": "old.test"}]})
+    assert list(api.get_all_sites_by_name(1)) == ["old.test"]
+
+    # the listing expires after its ttl and the view follows the refetched one
+    forge_mock.replace(
+        responses.GET, url, json={"sites": [{"id": 2, "name": "new.test"}]}
+    )
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 60)
+    assert list(api.get_all_sites_by_name(1)) == ["new.test"]
+
+
+@pytest.mark.e2e
 def test_deployment(server_id, fresh_deployment_config, second_deployment_config):
     try:
         # test fresh deployment
         run_deployment_script(FRESH_DEPLOYMENT_FILE)
-        for site_config in fresh_deployment_config.get("sites", []):
-            validate_site_configuration(server_id, site_config)
+        validate_sites(server_id, fresh_deployment_config)
 
         # test second deployment
         run_deployment_script(SECOND_DEPLOYMENT_FILE)
-        for site_config in second_deployment_config.get("sites", []):
-            validate_site_configuration(server_id, site_config)
+        validate_sites(server_id, second_deployment_config)
     finally:
         # pass
         cleanup_sites_and_daemons(server_id, second_deployment_config)